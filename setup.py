@@ -34,6 +34,9 @@ setuptools.setup(
         "Topic :: Software Development :: Libraries :: Python Modules",
     ],
     install_requires=parse_requirements('./requirements.txt'),
+    extras_require={
+        'analytics': ['numpy'],
+    },
     entry_points = {
         'console_scripts': ['toml-union=toml_union.toml_union:main'],
     },
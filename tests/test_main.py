@@ -1,7 +1,16 @@
 
 import os
+import json
+import shutil
+import subprocess
+import tempfile
+import tarfile
+import zipfile
 
-from toml_union import toml_union_process, read_toml
+import toml
+import pytest
+
+from toml_union import toml_union_process, combine_partials, read_toml, read_text, write_text, union_documents, LOCK_IDENTITY_KEYS, UnionIndex
 
 CUR_DIR = os.path.dirname(__file__)
 PROJECT_DIR = os.path.dirname(CUR_DIR)
@@ -63,6 +72,259 @@ def test_3():
     assert d1 == d2
 
 
+def test_only_if_changed():
+    result = os.path.join(PROJECT_DIR, 'tmp', 'test_only_if_changed.toml')
+    files = os.path.join(CUR_DIR, 'input', 'test_2')
+
+    toml_union_process(files=files, outfile=result)
+    mtime = os.stat(result).st_mtime_ns
+    os.utime(result, ns=(mtime - 10**9, mtime - 10**9))  # make mtime distinguishable
+
+    toml_union_process(files=files, outfile=result, only_if_changed=True)
+    assert os.stat(result).st_mtime_ns == mtime - 10**9, 'same content must not be rewritten'
+
+    toml_union_process(files=files, outfile=result, only_if_changed=True, overrides={'tool.poetry.name': 'other'})
+    assert os.stat(result).st_mtime_ns != mtime - 10**9
+    assert read_toml(result)['tool']['poetry']['name'] == 'other'
+
+
+def test_analytics():
+    result = os.path.join(PROJECT_DIR, 'tmp', 'test_analytics.json')
+    files = [
+        os.path.join(CUR_DIR, 'input', 'test_1', f) for f in ('file1.toml', 'file2.toml', 'file3.toml')
+    ]
+
+    toml_union_process(files=files, outfile=os.devnull, analytics=result)
+
+    with open(result, encoding='utf-8') as f:
+        data = json.load(f)
+
+    assert data['files'] == files
+    assert all(v > 0 for v in data['conflicts'].values())
+    assert [data['agreement'][i][i] for i in range(3)] == [1, 1, 1]
+    assert sorted(f for group in data['clusters'] for f in group) == sorted(files)
+
+    # conflicts resolved by overrides are still counted
+    toml_union_process(
+        files=files, outfile=os.devnull, analytics=result,
+        overrides_on_conflicts={'tool.poetry.dependencies.other_package': '3'}
+    )
+    with open(result, encoding='utf-8') as f:
+        assert json.load(f)['conflicts'] == data['conflicts']
+
+
+def test_union_documents():
+    folder = os.path.join(CUR_DIR, 'input', 'test_2')
+    docs = [
+        read_text(os.path.join(folder, 'f1.toml')),  # text
+        read_text(os.path.join(folder, 'f2.toml')).encode('utf-8'),  # bytes
+    ]
+
+    result = union_documents(docs)
+    assert result.output == read_toml(os.path.join(CUR_DIR, 'output', 'test_2', 'test2.toml'))
+    assert result.report is None, 'no conflicts expected'
+
+    folder = os.path.join(CUR_DIR, 'input', 'test_1')
+    result = union_documents(
+        [read_toml(os.path.join(folder, f)) for f in ('file1.toml', 'file2.toml')],  # parsed dicts
+        labels=['f1', 'f2']
+    )
+    assert result.report['tool']['poetry']['dependencies']['pdfminer.six'] == {
+        '^20220524': ['f1'], '^2022333333334': ['f2']
+    }
+
+
+def test_lock():
+    result = os.path.join(PROJECT_DIR, 'tmp', 'test_lock.lock')
+    report = os.path.join(PROJECT_DIR, 'tmp', 'test_lock.json')
+
+    toml_union_process(
+        files=os.path.join(CUR_DIR, 'input', 'test_lock'),
+        outfile=result,
+        report=report,
+        identity_keys=LOCK_IDENTITY_KEYS,
+        glob='*.lock'
+    )
+
+    packages = toml.load(result)['package']
+
+    assert sorted((p['name'], p['version']) for p in packages) == [
+        ('certifi', '2024.2.2'), ('requests', '2.31.0'), ('requests', '2.32.3')
+    ]
+    certifi = next(p for p in packages if p['name'] == 'certifi')
+    assert len(certifi['files']) == 2, 'same files must be merged'
+
+    with open(report, encoding='utf-8') as f:
+        conflicts = json.load(f)
+    assert sorted(conflicts['metadata']['content-hash']) == ['aaaa', 'bbbb']
+
+
+def test_incompatible_types():
+    for docs, route in (
+        ([b'[c]\nx = 1', b'c = 3\n[a]\nx = 2'], 'c'),  # table vs value
+        ([b'c = 3', b'[c]\nx = 1\n[a]\nx = 2'], 'c'),  # value vs table
+        ([b'[a]\nc = [1]', b'[a]\nc = 1\nd = 2'], 'a.c'),  # list vs value
+    ):
+        with pytest.raises(ValueError, match=f'^{route}: incompatible types'):
+            union_documents(docs)
+
+
+def test_git():
+    repo = tempfile.mkdtemp()
+    folder = os.path.join(CUR_DIR, 'input', 'test_1')
+
+    def git(*args):
+        subprocess.run(
+            ['git', '-C', repo, '-c', 'user.name=test', '-c', 'user.email=test@test', *args],
+            check=True, stdout=subprocess.DEVNULL
+        )
+
+    git('init', '-q')
+    for i in (1, 2):
+        shutil.copy(os.path.join(folder, f'file{i}.toml'), os.path.join(repo, 'pyproject.toml'))
+        git('add', 'pyproject.toml')
+        git('commit', '-q', '-m', f'commit {i}')
+    git('tag', 'v1', 'HEAD~1')
+
+    report = os.path.join(PROJECT_DIR, 'tmp', 'test_git.json')
+    toml_union_process(
+        files=['v1:pyproject.toml', 'HEAD:'],
+        outfile=os.path.join(PROJECT_DIR, 'tmp', 'test_git.toml'),
+        report=report,
+        git_repo=repo
+    )
+
+    with open(report, encoding='utf-8') as f:
+        conflicts = json.load(f)
+    assert conflicts['tool']['poetry']['dependencies']['pdfminer.six'] == {
+        '^20220524': ['v1:pyproject.toml'], '^2022333333334': ['HEAD:pyproject.toml']
+    }
+
+    shutil.rmtree(repo, ignore_errors=True)
+
+
+def test_archives():
+    folder = os.path.join(CUR_DIR, 'input', 'test_1')
+    archives = tempfile.mkdtemp()
+
+    sdist = os.path.join(archives, 'pkg-1.0.tar.gz')
+    with tarfile.open(sdist, 'w:gz') as tar:
+        tar.add(os.path.join(folder, 'file1.toml'), arcname='pkg-1.0/pyproject.toml')
+        tar.add(os.path.join(folder, 'file3.toml'), arcname='pkg-1.0/other.toml')
+
+    wheel = os.path.join(archives, 'pkg-2.0-py3-none-any.whl')
+    with zipfile.ZipFile(wheel, 'w') as z:
+        z.write(os.path.join(folder, 'file2.toml'), arcname='pkg-2.0/pyproject.toml')
+
+    report = os.path.join(PROJECT_DIR, 'tmp', 'test_archives.json')
+    toml_union_process(
+        files=[archives + '!*/pyproject.toml'],
+        outfile=os.path.join(PROJECT_DIR, 'tmp', 'test_archives.toml'),
+        report=report,
+        workers=2
+    )
+
+    with open(report, encoding='utf-8') as f:
+        conflicts = json.load(f)
+    assert conflicts['tool']['poetry']['dependencies']['pdfminer.six'] == {
+        '^20220524': [sdist + '!pkg-1.0/pyproject.toml'], '^2022333333334': [wheel + '!pkg-2.0/pyproject.toml']
+    }
+
+    # separate archives inputs keep their places among other inputs
+    toml_union_process(
+        files=[wheel, os.path.join(folder, 'file3.toml'), sdist + '!*/pyproject.toml'],
+        outfile=os.path.join(PROJECT_DIR, 'tmp', 'test_archives.toml'),
+        report=report,
+        workers=2
+    )
+
+    with open(report, encoding='utf-8') as f:
+        conflicts = json.load(f)
+    assert conflicts['tool']['poetry']['dependencies']['pdfminer.six'] == {
+        '^2022333333334': [wheel + '!pkg-2.0/pyproject.toml'],
+        '^20220524': [os.path.join(folder, 'file3.toml'), sdist + '!pkg-1.0/pyproject.toml']
+    }
+
+    shutil.rmtree(archives, ignore_errors=True)
+
+
+def test_index():
+    index = os.path.join(PROJECT_DIR, 'tmp', 'test_index.json')
+    folder = os.path.join(CUR_DIR, 'input', 'test_1')
+
+    toml_union_process(
+        files=folder, outfile=os.path.join(PROJECT_DIR, 'tmp', 'test_index.toml'), index=index,
+        overrides_on_conflicts={'tool.poetry.dependencies.pdfminer.six': 'overridden'}
+    )
+
+    i = UnionIndex.load(index)
+
+    assert i.query(route='tool.poetry.dependencies.torch', value='1.10.1+cu113') == {
+        'tool.poetry.dependencies.torch.version': {'1.10.1+cu113': [os.path.join(folder, 'file2.toml')]}
+    }
+    assert list(i.query(route='tool.poetry.dependencies.torch')) == [
+        'tool.poetry.dependencies.torch.source', 'tool.poetry.dependencies.torch.version'
+    ]
+    assert sorted(i.query(value='^20220524')['tool.poetry.dependencies.pdfminer.six']['^20220524']) == [
+        os.path.join(folder, 'file1.toml'), os.path.join(folder, 'file3.toml')
+    ], 'overridden values keep their sources'
+
+    # booleans are queried as TOML literals
+    folder = os.path.join(CUR_DIR, 'input', 'test_lock')
+    toml_union_process(
+        files=folder, outfile=os.path.join(PROJECT_DIR, 'tmp', 'test_index.lock'), index=index,
+        identity_keys=LOCK_IDENTITY_KEYS, glob='*.lock'
+    )
+    found = UnionIndex.load(index).query(value='false')
+    assert found and all(list(values) == ['false'] for values in found.values())
+
+
+def test_combine():
+    tmp = os.path.join(PROJECT_DIR, 'tmp', 'test_combine')
+    kwargs = dict(
+        remove_fields=['build-system'],
+        overrides={'tool.poetry.description': 'overridden'},
+        overrides_on_conflicts={'tool.poetry.authors': 'conflict author'}
+    )
+
+    versions = {  # version special case: the table meets the values from both sides of the shards split
+        'versions': ('"1.0"', '{version = "2.0", source = "x"}', '"3.0"'),
+        # the second shard has no version for the value, it comes from the first one
+        'versions_pending': ('{version = "2.0", source = "x"}', '"1.0"', '{git = "url"}'),
+    }
+    for test, tomls in versions.items():
+        versions[test] = [os.path.join(tmp, f'{test}_{i}.toml') for i in range(len(tomls))]
+        for f, torch in zip(versions[test], tomls):
+            write_text(f, f'[deps]\ntorch = {torch}\n')
+
+    for test, files in (
+        ('test_1', [os.path.join(CUR_DIR, 'input', 'test_1', f) for f in ('file1.toml', 'file2.toml', 'file3.toml')]),
+        ('test_3', [os.path.join(CUR_DIR, 'input', 'test_3', f) for f in ('dcr.toml', 'dml.toml', 'dweb.toml')]),
+        *versions.items()
+    ):
+        toml_union_process(
+            files=files,
+            outfile=os.path.join(tmp, f'{test}_single.toml'),
+            report=os.path.join(tmp, f'{test}_single.json'),
+            **kwargs
+        )
+
+        partials = []
+        for i, shard in enumerate((files[:1], files[1:])):
+            partials.append(os.path.join(tmp, f'{test}_partial_{i}.json'))
+            toml_union_process(files=shard, partial=partials[-1], **kwargs)
+
+        combine_partials(
+            partials,
+            outfile=os.path.join(tmp, f'{test}_combined.toml'),
+            report=os.path.join(tmp, f'{test}_combined.json'),
+            **kwargs
+        )
+
+        for ext in ('toml', 'json'):
+            assert read_text(os.path.join(tmp, f'{test}_single.{ext}')) == read_text(os.path.join(tmp, f'{test}_combined.{ext}'))
+
+
 if __name__ == '__main__':
     test_3()
 
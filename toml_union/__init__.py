@@ -1,2 +1,2 @@
 
-from .toml_union import toml_union_process, override_param, remove_field, read_toml, write_toml, write_json, read_text, write_text
+from .toml_union import toml_union_process, override_param, remove_field, read_toml, write_toml, write_json, read_text, write_text, dumps_toml, loads_toml, union_documents, UnionResult, FlatData, LOCK_IDENTITY_KEYS, UnionIndex, combine_partials, PartialState
@@ -0,0 +1,206 @@
+"""
+conflicts analytics over the union result
+
+requires numpy: pip install toml-union[analytics]
+"""
+
+from typing import Dict, Any, List, Union, Callable, Tuple
+
+import os
+import csv
+import io
+import json
+from dataclasses import dataclass
+
+import numpy as np
+
+from .toml_union import DATA_DICT, FlatData, iter_data_dict, write_text
+
+
+def is_pin_route(route: Tuple[str, ...]) -> bool:
+    """default filter of the routes with dependencies pins"""
+    return 'dependencies' in route
+
+
+@dataclass
+class ConflictMatrix:
+    """
+    (route, value) x source file matrix built from the union result
+
+    >>> from .toml_union import union_dicts
+    >>> t1 = dict(dependencies=dict(a='1', b='1'), name='x')
+    >>> t2 = dict(dependencies=dict(a='2', b='1'), name='y')
+    >>> t3 = dict(dependencies=dict(a='1', b='1'))
+    >>> m = ConflictMatrix.from_data_dict(union_dicts([t1, t2, t3]), files=['f1', 'f2', 'f3'])
+    >>> m.matrix.shape
+    (5, 3)
+    >>> m.file_conflicts()
+    array([2, 2, 1])
+    >>> m.file_agreement().round(2)
+    array([[1.  , 0.33, 1.  ],
+           [0.33, 1.  , 0.5 ],
+           [1.  , 0.5 , 1.  ]], dtype=float32)
+    >>> m.file_clusters()
+    [['f1', 'f3'], ['f2']]
+    """
+
+    routes: List[str]
+    """dot-joined route of each row"""
+    values: List[Any]
+    """value of each row"""
+    route_ids: np.ndarray
+    """index of the row route in unique routes"""
+    is_list: np.ndarray
+    """whether the row value is the list item (list items are not the conflicts to each other)"""
+    files: List[str]
+    """columns labels"""
+    matrix: np.ndarray
+    """boolean matrix, True means the file has this value on this route"""
+
+    @staticmethod
+    def from_data_dict(dct: Union[DATA_DICT, FlatData], files: List[str]) -> 'ConflictMatrix':
+        """
+        builds the matrix from data dict or flat data
+
+        Args:
+            dct: union result
+            files: sources labels in order of their indexes in the data dict
+
+        Notes:
+            negative sources (overrides) are not included
+        """
+        routes: List[str] = []
+        values: List[Any] = []
+        route_ids: List[int] = []
+        is_list: List[bool] = []
+        routes_map: Dict[Tuple[str, ...], int] = {}
+
+        rows: List[int] = []
+        cols: List[int] = []
+
+        for route, value, in_list in (dct.iter_values() if isinstance(dct, FlatData) else iter_data_dict(dct)):
+            route_id = routes_map.setdefault(route, len(routes_map))
+            r = '.'.join(route)
+            for v, sources in value.map.items():
+                row = len(values)
+                routes.append(r)
+                values.append(v)
+                route_ids.append(route_id)
+                is_list.append(in_list)
+                for s in sources:
+                    if s >= 0:
+                        rows.append(row)
+                        cols.append(s)
+
+        matrix = np.zeros((len(values), len(files)), dtype=bool)
+        matrix[np.array(rows, dtype=int), np.array(cols, dtype=int)] = True
+
+        return ConflictMatrix(
+            routes=routes,
+            values=values,
+            route_ids=np.array(route_ids, dtype=int),
+            is_list=np.array(is_list, dtype=bool),
+            files=list(files),
+            matrix=matrix
+        )
+
+    @property
+    def routes_count(self) -> int:
+        """count of unique routes"""
+        return int(self.route_ids.max()) + 1 if self.route_ids.size else 0
+
+    def _scalars(self) -> Tuple[np.ndarray, np.ndarray]:
+        """route ids and matrix of rows which are not list items"""
+        mask = ~self.is_list
+        return self.route_ids[mask], self.matrix[mask]
+
+    def conflict_rows(self) -> np.ndarray:
+        """mask of the rows which are the values of conflict routes"""
+        counts = np.bincount(self.route_ids[~self.is_list], minlength=self.routes_count)
+        return ~self.is_list & (counts[self.route_ids] > 1)
+
+    def file_conflicts(self) -> np.ndarray:
+        """count of conflict routes for each file"""
+        return self.matrix[self.conflict_rows()].sum(axis=0)
+
+    def file_agreement(self) -> np.ndarray:
+        """
+        files x files matrix of agreement scores:
+            share of the routes defined by both files where they have the same value
+        """
+        route_ids, m = self._scalars()
+
+        defined = np.zeros((self.routes_count, len(self.files)), dtype=bool)
+        np.logical_or.at(defined, route_ids, m)
+
+        # float32 keeps the counts exact up to 2**24 routes and uses BLAS unlike the integers
+        m = m.astype(np.float32)
+        same = m.T @ m
+        del m
+        defined = defined.astype(np.float32)
+        both = defined.T @ defined
+
+        return np.divide(same, both, out=np.zeros_like(same), where=both > 0)
+
+    def file_clusters(
+        self,
+        routes_filter: Callable[[Tuple[str, ...]], bool] = is_pin_route
+    ) -> List[List[str]]:
+        """
+        groups the files which have exactly the same values on filtered routes
+
+        Args:
+            routes_filter: function to select the routes by their keys, default is for dependencies pins
+
+        Returns:
+            files groups from biggest to smallest
+        """
+        mask = np.array(
+            [routes_filter(tuple(r.split('.'))) for r in self.routes], dtype=bool
+        ) if self.routes else np.zeros(0, dtype=bool)
+
+        _, labels = np.unique(self.matrix[mask].T, axis=0, return_inverse=True)
+        labels = labels.ravel()
+
+        groups = [
+            [self.files[i] for i in np.flatnonzero(labels == label)]
+            for label in range(labels.max() + 1 if labels.size else 0)
+        ]
+        groups.sort(key=lambda g: (-len(g), g[0]))
+        return groups
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'files': self.files,
+            'conflicts': dict(zip(self.files, self.file_conflicts().tolist())),
+            'agreement': self.file_agreement().round(4).tolist(),
+            'clusters': self.file_clusters()
+        }
+
+    def to_csv(self) -> str:
+        """files table with conflicts counts, cluster numbers and agreement scores to other files"""
+        conflicts = self.file_conflicts()
+        agreement = self.file_agreement().round(4)
+        cluster_of = {
+            f: i for i, group in enumerate(self.file_clusters()) for f in group
+        }
+
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(['file', 'conflicts', 'cluster'] + self.files)
+        for i, f in enumerate(self.files):
+            writer.writerow([f, int(conflicts[i]), cluster_of[f]] + agreement[i].tolist())
+        return out.getvalue()
+
+
+def write_analytics(
+    file_name: Union[str, os.PathLike],
+    matrix: ConflictMatrix,
+    only_if_changed: bool = False
+) -> bool:
+    """writes analytics to *.csv or *.json file depending on its extension"""
+    if str(file_name).lower().endswith('.csv'):
+        text = matrix.to_csv()
+    else:
+        text = json.dumps(matrix.to_json(), indent=2)
+    return write_text(file_name, text, only_if_changed=only_if_changed)
@@ -3,18 +3,28 @@
 python toml_union.py -h
 """
 
-from typing import Dict, Any, List, Union, Iterable, Callable, Optional
+from typing import Dict, Any, List, Union, Iterable, Callable, Optional, Tuple, Sequence
 
 import sys
 import os
 from pathlib import Path
 import copy
+import shutil
 import json
 from collections import defaultdict
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from functools import reduce
 import tempfile
 import pprint
+import uuid
+import fnmatch
+import subprocess
+import threading
+import zipfile
+import tarfile
+import concurrent.futures
+import bisect
+import itertools
 
 import argparse
 
@@ -90,11 +100,16 @@ class TomlValue:
     def __str__(self):
         return 'TomlValue  ' + ' ; '.join(f"{k} -> {tuple(v)}" for k, v in self.map.items())
 
+    @staticmethod
+    def to_key(value: Any) -> Union[str, int, float]:
+        """converts the value to the key of the map"""
+        return value if isinstance(value, (str, int, float)) else json.dumps(value)
+
     @staticmethod
     def from_value(value: Any, index: int):
         """initial constructor"""
         return TomlValue(
-            {value if isinstance(value, (str, int, float)) else json.dumps(value): [index]}
+            {TomlValue.to_key(value): [index]}
         )
 
     def add(self, value: str, index: Union[int, List[int]]):
@@ -106,6 +121,18 @@ class TomlValue:
         for v, indexes in obj.map.items():
             _add_sources_to_dict(d, v, indexes)
 
+    def sort(self):
+        """
+        orders the values by their first sources and the sources inside,
+            like the values were added source by source
+
+        >>> v = TomlValue({'2.0': [1], '3.0': [2]}); v.update(TomlValue({'1.0': [0, 4], '3.0': [3]})); v.sort(); v
+        TomlValue(map={'1.0': [0, 4], '2.0': [1], '3.0': [2, 3]})
+        """
+        self.map = {
+            v: sorted(indexes) for v, indexes in sorted(self.map.items(), key=lambda item: min(item[1]))
+        }
+
     @staticmethod
     def union_list(items: List['TomlValue']) -> List['TomlValue']:
         """
@@ -197,7 +224,16 @@ def sort_dict(dct: TOML_DICT) -> TOML_DICT:
     return res
 
 
-def disable_lists_dict(dct: TOML_DICT) -> TOML_DICT:
+IDENTITY_KEYS = Dict[str, Sequence[str]]
+"""array of tables key -> fields which identify its items"""
+
+LOCK_IDENTITY_KEYS: IDENTITY_KEYS = {
+    'package': ('name', 'version'),
+}
+"""identity keys for lock files like poetry.lock"""
+
+
+def disable_lists_dict(dct: TOML_DICT, identity_keys: Optional[IDENTITY_KEYS] = None) -> TOML_DICT:
     """
     replace constructions like
 
@@ -216,36 +252,53 @@ def disable_lists_dict(dct: TOML_DICT) -> TOML_DICT:
         [tool.poetry.source___PyPI]
         priority = "primary"
 
+    Args:
+        dct:
+        identity_keys: fields to extract dicts for arrays with such keys (lock mode),
+            other arrays are extracted using 'name' field if possible and kept as is otherwise
+
     Notes:
         extracts dict using 'name' field
+
+    >>> t = {'package': [{'name': 'a', 'version': '1', 'files': [{'file': 'a.whl'}]}, {'name': 'a', 'version': '2'}]}
+    >>> disable_lists_dict(t, identity_keys=LOCK_IDENTITY_KEYS)
+    {'package___a___1': {'files': [{'file': 'a.whl'}]}, 'package___a___2': {}}
     """
 
     def process(data: TOML_DICT) -> TOML_DICT:
-        d = copy.deepcopy(data)
+        d = {}
+        new_dicts = {}
+        """new dicts with processed dicts of list items with updated names, they go after other keys"""
 
         for k, v in data.items():
             if isinstance(v, list) and len(v) > 0 and isinstance(v[0], dict):  # it is the list of dicts
 
-                if all('name' in item for item in v):
-                    new_dicts = {
-                        f"{k}{SEP}{item['name']}": process({_k: _v for _k, _v in item.items() if _k != 'name'})
-                        for item in v
-                    }
-                    """new dict with processed dicts of list items with updated names"""
-                    d.pop(k)
-                    d.update(new_dicts)
-                else:
+                keys = identity_keys.get(k) if identity_keys else None
+                if not (keys and all(item.keys() >= set(keys) for item in v)):
+                    keys = ('name',)
+
+                if all(item.keys() >= set(keys) for item in v):
+                    for item in v:
+                        name = SEP.join(str(item[_k]) for _k in keys)
+                        new_dicts[f"{k}{SEP}{name}"] = process({_k: _v for _k, _v in item.items() if _k not in keys})
+                    continue
+
+                if identity_keys is None:
                     assert all('version' in item for item in v), v
 
             elif isinstance(v, dict):  # go deeper
-                d[k] = process(v)
+                v = process(v)
+
+            d[k] = v
+
+        d.update(new_dicts)
 
         return d
 
     return process(dct)
 
 
-def enable_lists_dicts(dct: TOML_DICT) -> TOML_DICT:
+def enable_lists_dicts(dct: TOML_DICT, identity_keys: Optional[IDENTITY_KEYS] = None) -> TOML_DICT:
     """
     reverses disable_lists_dict effect
 
@@ -254,10 +307,14 @@ def enable_lists_dicts(dct: TOML_DICT) -> TOML_DICT:
     {'root___name1': {'other': '1', 'data': 'data1'}, 'root___name2': {'other': '2', 'data': 'data2'}}
     >>> enable_lists_dicts(converted)
     {'root': [{'other': '1', 'data': 'data1', 'name': 'name1'}, {'other': '2', 'data': 'data2', 'name': 'name2'}]}
+
+    in lock mode identity fields go first:
+    >>> enable_lists_dicts({'package___a___1': {'files': []}}, identity_keys=LOCK_IDENTITY_KEYS)
+    {'package': [{'name': 'a', 'version': '1', 'files': []}]}
     """
 
     def process(data: TOML_DICT) -> TOML_DICT:
-        d = copy.deepcopy(data)
+        d = {}
 
         list_dicts: Dict[str, List[TOML_DICT]] = defaultdict(list)
         """recovered dictionaries which contain lists of dicts"""
@@ -268,11 +325,21 @@ def enable_lists_dicts(dct: TOML_DICT) -> TOML_DICT:
                 v = process(v)  # go deeper
                 if SEP in k:  # move to storage
                     parent, name = k.split(SEP, 1)
-                    v['name'] = name
+                    if identity_keys is None:
+                        v['name'] = name
+                    else:
+                        keys = identity_keys.get(parent, ('name',))
+                        names = name.split(SEP, len(keys) - 1)
+                        if len(names) != len(keys):  # extracted by name only
+                            keys = ('name',)
+                            names = [name]
+                        item = dict(zip(keys, names))
+                        item.update(v)
+                        v = item
                     list_dicts[parent].append(v)
-                    d.pop(k)  # remove this version from result
-                else:  # just keep in result
-                    d[k] = v
+                    continue
+
+            d[k] = v
 
         d.update(dict(list_dicts))
 
@@ -285,41 +352,122 @@ def read_text(file_name: Union[str, os.PathLike]) -> str:
     return Path(file_name).read_text(encoding='utf-8')
 
 
-def write_text(file_name: Union[str, os.PathLike], text: str):
+def _is_same_content(file_name: Union[str, os.PathLike], data: bytes) -> bool:
+    """checks whether the file exists and already has exactly this content"""
+    path = Path(file_name)
+    try:
+        if path.stat().st_size != len(data):  # cheap check before reading
+            return False
+        return path.read_bytes() == data
+    except OSError:  # no file or it is not readable
+        return False
+
+
+def write_text(file_name: Union[str, os.PathLike], text: str, only_if_changed: bool = False) -> bool:
+    """
+    writes text to file atomically: the text goes to a temporary file in the same directory
+        which is renamed to target after, so readers never see a half-written file
+
+    Args:
+        file_name:
+        text:
+        only_if_changed: whether to skip writing (and so keep the file mtime) if the file already has same content
+
+    Returns:
+        whether the file was written
+
+    >>> f = os.path.join(tempfile.mkdtemp(), 'dir', 'file.txt')
+    >>> write_text(f, 'text'), write_text(f, 'text', only_if_changed=True), write_text(f, 'text 2', only_if_changed=True)
+    (True, False, True)
+    >>> read_text(f)
+    'text 2'
+
+    symlinks are followed and the mode of existing file is kept:
+    >>> link = f + '.link'; os.symlink(f, link); os.chmod(f, 0o640)
+    >>> write_text(link, 'text 3'), read_text(f), os.path.islink(link), oct(os.stat(f).st_mode & 0o777)
+    (True, 'text 3', True, '0o640')
+    """
+    data = text.encode('utf-8')
+    if only_if_changed and _is_same_content(file_name, data):
+        return False
+
     mkdir_of_file(file_name)
-    Path(file_name).write_text(text, encoding='utf-8')
+    path = Path(os.path.realpath(file_name))  # write through symlinks instead of replacing them
+    if path.exists() and not path.is_file():  # devices like /dev/null or pipes cannot be replaced
+        with open(path, 'wb') as f:
+            f.write(data)
+        return True
+
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp, 'xb') as f:
+            f.write(data)
+        if path.exists():  # keep the mode of existing file
+            shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+
+    return True
+
+
+def loads_toml(text: Union[str, bytes], identity_keys: Optional[IDENTITY_KEYS] = None) -> TOML_DICT:
+    """
+    reads dict from toml text with some preprocessing, identity_keys are for disable_lists_dict
 
+    >>> loads_toml(b'[[source]]\\nname = "pytorch"\\nurl = "url"')
+    {'source___pytorch': {'url': 'url'}}
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
 
-def read_toml(file_name: Union[str, os.PathLike]) -> TOML_DICT:
-    """reads dict from toml with some preprocessing"""
-    with open(file_name, 'r', encoding='utf-8') as f:
-        content = toml.load(f)
+    return disable_lists_dict(toml.loads(text), identity_keys=identity_keys)
 
-    content = disable_lists_dict(content)
 
-    return content
+def read_toml(file_name: Union[str, os.PathLike], identity_keys: Optional[IDENTITY_KEYS] = None) -> TOML_DICT:
+    """reads dict from toml with some preprocessing"""
+    return loads_toml(read_text(file_name), identity_keys=identity_keys)
 
 
-def write_toml(file_name: Union[str, os.PathLike], data: TOML_DICT, unicode_escape: bool = False):
-    """writes dict to toml with some postprocessing"""
-    mkdir_of_file(file_name)
-    data = enable_lists_dicts(data)
+def dumps_toml(
+    data: TOML_DICT,
+    unicode_escape: bool = False,
+    identity_keys: Optional[IDENTITY_KEYS] = None
+) -> str:
+    """converts dict to toml text with some postprocessing"""
+    data = enable_lists_dicts(data, identity_keys=identity_keys)
     data = sort_dict(data)
 
-    write_text(file_name, tomli_w.dumps(data))
+    text = tomli_w.dumps(data)
 
     if unicode_escape:
-        write_text(
-            file_name,
-            read_text(file_name).encode().decode('unicode_escape').replace('"', "'")
-        )
+        text = text.encode().decode('unicode_escape').replace('"', "'")
+
+    return text
+
+
+def write_toml(
+    file_name: Union[str, os.PathLike],
+    data: TOML_DICT,
+    unicode_escape: bool = False,
+    only_if_changed: bool = False,
+    identity_keys: Optional[IDENTITY_KEYS] = None
+) -> bool:
+    """writes dict to toml with some postprocessing, returns whether the file was written"""
+    return write_text(
+        file_name,
+        dumps_toml(data, unicode_escape=unicode_escape, identity_keys=identity_keys),
+        only_if_changed=only_if_changed
+    )
 
 
-def write_json(file_name: Union[str, os.PathLike], data: TOML_DICT):
-    """writes dict to json without special postprocessing"""
-    mkdir_of_file(file_name)
-    with open(file_name, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, sort_keys=True)
+def write_json(file_name: Union[str, os.PathLike], data: TOML_DICT, only_if_changed: bool = False) -> bool:
+    """writes dict to json without special postprocessing, returns whether the file was written"""
+    return write_text(
+        file_name, json.dumps(data, indent=2, sort_keys=True), only_if_changed=only_if_changed
+    )
 
 
 def to_data_dict(dct: TOML_DICT, index: int = 0) -> DATA_DICT:
@@ -374,6 +522,27 @@ def to_dict(dct: DATA_DICT, converter: Callable[[TomlValue], Any] = TomlValue.to
     return res
 
 
+def iter_data_dict(dct: DATA_DICT, route: tuple = ()) -> Iterable[tuple]:
+    """
+    walks through data dict leaves
+
+    Returns:
+        generator of (route keys tuple, value, whether the value is the list item)
+
+    >>> list(iter_data_dict(to_data_dict(dict(a=1, b=[2, 3], c={'d': 4}))))
+    [(('a',), TomlValue(map={1: [0]}), False), (('b',), TomlValue(map={2: [0]}), True), (('b',), TomlValue(map={3: [0]}), True), (('c', 'd'), TomlValue(map={4: [0]}), False)]
+    """
+    for k, v in dct.items():
+        r = route + (k,)
+        if isinstance(v, dict):
+            yield from iter_data_dict(v, r)
+        elif isinstance(v, list):
+            for item in v:
+                yield r, item, True
+        else:
+            yield r, v, False
+
+
 def union_2_data_dicts(d1: DATA_DICT, d2: DATA_DICT) -> DATA_DICT:
     """
     performs data dicts deep union
@@ -411,12 +580,14 @@ def union_2_data_dicts(d1: DATA_DICT, d2: DATA_DICT) -> DATA_DICT:
                     version = v1['version']
                     if isinstance(version, TomlValue):
                         version.update(v2)
+                        version.sort()
                         continue
 
                 if isinstance(v2, dict) and 'version' in v2:
                     version = v2['version']
                     if isinstance(version, TomlValue):
                         version.update(v1)  # update version object
+                        version.sort()  # v1 sources may be before v2 ones
                         d1[key] = v2  # assign v2 object to v1 dictionary
                         continue
 
@@ -514,8 +685,1140 @@ def remove_field(dct: Dict, route: str):
 #endregion
 
 
+#region FLAT DATA
+
+ROUTE = Tuple[str, ...]
+"""keys path to the value"""
+
+
+@dataclass
+class FlatData:
+    """
+    flat alternative to DATA_DICT: values are stored by their full routes
+        and tables are stored in prefix index, so no recursion is needed
+
+    >>> f = FlatData.from_dict(dict(a=1, b=[1, 2], c={'d': 3, 'e': {}}), index=9); f
+    FlatData(values={('a',): TomlValue(map={1: [9]}), ('b',): [TomlValue(map={1: [9]}), TomlValue(map={2: [9]})], ('c', 'd'): TomlValue(map={3: [9]})}, tables={(): {'a': None, 'b': None, 'c': None}, ('c',): {'d': None, 'e': None}, ('c', 'e'): {}})
+    >>> f.to_dict()
+    {'a': 1, 'b': [1, 2], 'c': {'d': 3, 'e': {}}}
+    >>> f.to_data_dict() == to_data_dict(f.to_dict(), index=9)
+    True
+    """
+
+    values: Dict[ROUTE, Union[TomlValue, List[TomlValue]]]
+    """route -> leaf value"""
+    tables: Dict[ROUTE, Dict[str, None]]
+    """prefix index: table route -> its keys in their order, the root table has empty route"""
+    pending: Optional[Dict[ROUTE, TomlValue]] = field(default=None, repr=False, compare=False)
+    """
+    partial union only: table route -> values which met the table without version yet,
+        the version may come from other files shard, see resolve_pending; None means to fail immediately
+    """
+
+    @staticmethod
+    def from_dict(dct: TOML_DICT, index: int = 0, route: ROUTE = ()) -> 'FlatData':
+        """converts usual dict to flat data, same as to_data_dict; route is the route of the dict itself"""
+
+        values = {}
+        tables = {}
+
+        stack = [(route, dct)]
+        while stack:
+            route, table = stack.pop()
+            tables[route] = dict.fromkeys(table)
+            for key, value in table.items():
+                r = route + (key,)
+                if isinstance(value, dict):  # go deeper later
+                    stack.append((r, value))
+                else:
+                    assert isinstance(value, (list, str, int)), f"unexpected value {value} type: {type(value)}"
+
+                    if isinstance(value, list):
+                        values[r] = [
+                            TomlValue.from_value(v, index) for v in value
+                        ]
+                    else:
+                        values[r] = TomlValue.from_value(value, index)
+
+        return FlatData(values, tables)
+
+    @staticmethod
+    def from_data_dict(dct: DATA_DICT) -> 'FlatData':
+        """converts data dict to flat data, values are not copied"""
+        values = {}
+        tables = {}
+
+        stack = [((), dct)]
+        while stack:
+            route, table = stack.pop()
+            tables[route] = dict.fromkeys(table)
+            for key, value in table.items():
+                if isinstance(value, dict):
+                    stack.append((route + (key,), value))
+                else:
+                    values[route + (key,)] = value
+
+        return FlatData(values, tables)
+
+    def to_dict(self, converter: Callable[[TomlValue], Any] = TomlValue.to_toml) -> TOML_DICT:
+        """converts flat data to usual toml dict, same as to_dict for data dict"""
+        return self._build(
+            lambda v: [converter(obj) for obj in v] if isinstance(v, list) else converter(v)
+        )
+
+    def to_data_dict(self) -> DATA_DICT:
+        """converts flat data to data dict, values are not copied"""
+        return self._build(lambda v: v)
+
+    def iter_values(self) -> Iterable[tuple]:
+        """
+        same as iter_data_dict over to_data_dict() but without nesting restore
+
+        >>> list(FlatData.from_dict(dict(a=1, b=[2, 3], c={'d': 4})).iter_values())
+        [(('a',), TomlValue(map={1: [0]}), False), (('b',), TomlValue(map={2: [0]}), True), (('b',), TomlValue(map={3: [0]}), True), (('c', 'd'), TomlValue(map={4: [0]}), False)]
+        """
+        for route, v in self.values.items():
+            if isinstance(v, list):
+                for item in v:
+                    yield route, item, True
+            else:
+                yield route, v, False
+
+    def _build(
+        self,
+        converter: Callable[[Union[TomlValue, List[TomlValue]]], Any],
+        route: ROUTE = ()
+    ) -> Dict[str, Any]:
+        """restores nesting once for all tables and returns the table on this route"""
+        tables = self.tables
+        values = self.values
+
+        objects = {r: {} for r in tables}
+        for table_route, keys in tables.items():
+            obj = objects[table_route]
+            for key in keys:
+                r = table_route + (key,)
+                obj[key] = objects[r] if r in objects else converter(values[r])
+
+        return objects[route]
+
+    def update(self, other: 'FlatData'):
+        """
+        union current data with other one, the values of other are not copied
+
+        >>> t1 = dict(a=1, b=[2], c={'d': [3, 4]}, v='1.0')
+        >>> t2 = dict(b=[3], c={'d': [6, 4], 'e': 8}, v={'version': '2.0', 'extras': ['x']})
+        >>> f = FlatData.from_dict(t1, index=-1); f.update(FlatData.from_dict(t2, index=-2))
+        >>> f.to_data_dict() == union_2_data_dicts(to_data_dict(t1, index=-1), to_data_dict(t2, index=-2))
+        True
+        >>> f.update(FlatData.from_dict(dict(a=[1]), index=-3))  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: a: incompatible types...
+        >>> FlatData.from_dict({'c': {}}).update(FlatData.from_dict({'c': '3', 'a': '1'}, 1))  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: c: incompatible types...
+        """
+
+        values = self.values
+        tables = self.tables
+
+        for route, keys in other.tables.items():
+            if route in values:  # leaf here vs table in other
+                v1 = values[route]
+                version = other.values.get(route + ('version',))
+                if isinstance(v1, TomlValue) and isinstance(version, TomlValue):
+                    # special versions case like
+                    #   httpx = "^0.27.0"
+                    #       vs
+                    #   httpx = {extras = ["socks", "brotli", "http2"], version = "^0.26"}
+                    version.update(v1)
+                    version.sort()  # same order as for the values added source by source
+                elif not self._defer(route, v1, version, other):
+                    self._raise_incompatible(route, v1, other._table(route))
+                values.pop(route)
+
+            if route in tables:
+                tables[route].update(keys)
+            else:
+                tables[route] = keys.copy()
+
+        for route, v2 in other.values.items():
+            if route in values:
+                v1 = values[route]
+                if isinstance(v1, list) and isinstance(v2, list):
+                    values[route] = TomlValue.union_list(v1 + v2)
+                elif isinstance(v1, TomlValue) and isinstance(v2, TomlValue):
+                    v1.update(v2)
+                else:
+                    self._raise_incompatible(route, v1, v2)
+
+            elif route in tables:  # table here vs leaf in other
+                version = values.get(route + ('version',))
+                if isinstance(v2, TomlValue) and isinstance(version, TomlValue):
+                    version.update(v2)
+                    version.sort()
+                elif not self._defer(route, v2, version, self):
+                    self._raise_incompatible(route, self._table(route), v2)
+
+            else:
+                values[route] = v2
+
+        if other.pending:
+            if self.pending is None:
+                self.pending = {}
+            for route, v in other.pending.items():
+                self._defer(route, v, None, self)
+
+    def add_dict(self, dct: TOML_DICT, index: int):
+        """
+        union current data with usual dict,
+            same as update(FlatData.from_dict(dct, index)) but without intermediate objects
+
+        >>> t1 = dict(a=1, b=[2], c={'d': [3, 4]}, v='1.0', w={'version': '1'})
+        >>> t2 = dict(b=[3], c={'d': [6, 4], 'e': 8}, v={'version': '2.0', 'extras': ['x']}, w='2')
+        >>> f = FlatData.from_dict(t1, index=0); f.add_dict(t2, index=1)
+        >>> g = FlatData.from_dict(t1, index=0); g.update(FlatData.from_dict(t2, index=1))
+        >>> f == g
+        True
+        """
+        values = self.values
+        tables = self.tables
+
+        stack = [((), dct)]
+        while stack:
+            route, table = stack.pop()
+
+            if route in values:  # leaf here vs table in dict
+                self.update(FlatData.from_dict(table, index, route=route))
+                continue
+
+            keys = tables.get(route)
+            if keys is None:
+                keys = tables[route] = {}
+
+            for key, value in table.items():
+                keys[key] = None
+                r = route + (key,)
+                if isinstance(value, dict):  # go deeper later
+                    stack.append((r, value))
+                    continue
+
+                assert isinstance(value, (list, str, int)), f"unexpected value {value} type: {type(value)}"
+
+                v1 = values.get(r)
+                if v1 is None:
+                    v2 = [
+                        TomlValue.from_value(v, index) for v in value
+                    ] if isinstance(value, list) else TomlValue.from_value(value, index)
+                    if r in tables:  # table here vs leaf in dict
+                        version = values.get(r + ('version',))
+                        if isinstance(v2, TomlValue) and isinstance(version, TomlValue):
+                            version.update(v2)
+                        elif not self._defer(r, v2, version, self):
+                            self._raise_incompatible(r, self._table(r), v2)
+                    else:
+                        values[r] = v2
+
+                elif isinstance(value, list) and isinstance(v1, list):
+                    values[r] = TomlValue.union_list(
+                        v1 + [TomlValue.from_value(v, index) for v in value]
+                    )
+                elif not isinstance(value, list) and isinstance(v1, TomlValue):
+                    v1.add(TomlValue.to_key(value), index)
+                else:
+                    self._raise_incompatible(r, v1, value)
+
+    def _defer(self, route: ROUTE, value: Any, version: Any, table_data: 'FlatData') -> bool:
+        """
+        keeps the value which met the table without version in pending values of partial union,
+            returns whether it is kept
+
+        Args:
+            route: table route
+            value: the value
+            version: current version of the table
+            table_data: data with the table
+        """
+        if self.pending is None or not isinstance(value, TomlValue):
+            return False
+        if version is not None or route + ('version',) in table_data.tables:  # the version is not a value
+            return False
+
+        if route in self.pending:
+            self.pending[route].update(value)
+        else:
+            self.pending[route] = value
+        return True
+
+    def resolve_pending(self):
+        """
+        merges pending values of partial union to the versions of their tables
+
+        >>> f = union_flat_dicts([{'a': '1'}, {'a': {'git': 'x'}}], partial=True); f.pending
+        {('a',): TomlValue(map={'1': [0]})}
+        >>> f.update(FlatData.from_dict({'a': {'version': '2'}}, index=2)); f.resolve_pending(); f.to_dict()
+        {'a': {'git': 'x', 'version': ['1', '2']}}
+        >>> f = union_flat_dicts([{'a': '1'}, {'a': {'git': 'x'}}], partial=True); f.resolve_pending()  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: a: incompatible types...
+        """
+        pending = self.pending or {}
+        self.pending = None
+
+        for route, value in pending.items():
+            version = self.values.get(route + ('version',))
+            if not isinstance(version, TomlValue):
+                self._raise_incompatible(route, self._table(route), value)
+            version.update(value)
+            version.sort()
+
+    @staticmethod
+    def _raise_incompatible(route: ROUTE, v1: Any, v2: Any):
+        raise ValueError(
+            f"{'.'.join(route)}: incompatible types\n{pprint.pformat(v1)}\n\tand\n{pprint.pformat(v2)}"
+        )
+
+    def _table(self, route: ROUTE) -> DATA_DICT:
+        """
+        data dict of the table on this route only, skips the keys without values yet,
+            so it is safe in the middle of the union unlike _build
+
+        >>> FlatData.from_dict({'c': {'d': {'e': 1}}}, index=0)._table(('c',))
+        {'d': {'e': TomlValue(map={1: [0]})}}
+        """
+        table = {}
+        stack = [(route, table)]
+        while stack:
+            r, obj = stack.pop()
+            for key in self.tables[r]:
+                rr = r + (key,)
+                if rr in self.tables:
+                    obj[key] = {}
+                    stack.append((rr, obj[key]))
+                elif rr in self.values:
+                    obj[key] = self.values[rr]
+        return table
+
+    def _subtree(self, route: ROUTE) -> Tuple[List[ROUTE], List[ROUTE]]:
+        """tables and values routes under the table on this route including it"""
+        tables_routes = []
+        values_routes = []
+        stack = [route]
+        while stack:
+            r = stack.pop()
+            tables_routes.append(r)
+            for key in self.tables[r]:
+                rr = r + (key,)
+                (stack if rr in self.tables else values_routes).append(rr)
+        return tables_routes, values_routes
+
+    def remove(self, route: str):
+        """
+        removes the field on this route, same as remove_field for data dict
+
+        >>> f = FlatData.from_dict(dict(a=1, b=dict(c=2, d=dict(f=3, e=4))))
+        >>> f.remove('b.d.e'); f.remove('b.x.y'); f.to_dict()
+        {'a': 1, 'b': {'c': 2, 'd': {'f': 3}}}
+        >>> f.remove('b'); f
+        FlatData(values={('a',): TomlValue(map={1: [0]})}, tables={(): {'a': None}})
+        """
+        r = tuple(route.split('.'))
+        parent = self.tables.get(r[:-1])
+        if parent is None or r[-1] not in parent:
+            return
+
+        parent.pop(r[-1])
+        if r in self.values:
+            self.values.pop(r)
+            return
+
+        tables_routes, values_routes = self._subtree(r)
+        for rr in tables_routes:
+            self.tables.pop(rr)
+        for rr in values_routes:
+            self.values.pop(rr)
+
+    def override(self, route: str, value: Union[str, List[str]], only_on_conflict: bool = False):
+        """
+        performs override operation, same as override_param for data dict
+
+        >>> f = FlatData.from_dict(dict(main=dict(a=1, c=2)), index=0); f.update(FlatData.from_dict(dict(main=dict(a=1, c=3)), index=1))
+        >>> f.override('main.a', 2, only_on_conflict=True); f.override('main.c', 4, only_on_conflict=True); f.override('x.y', 5)
+        >>> f.to_data_dict()
+        {'main': {'a': TomlValue(map={1: [0, 1]}), 'c': TomlValue(map={4: [-1]})}, 'x': {'y': TomlValue(map={5: [-1]})}}
+        """
+        r = tuple(route.split('.'))
+        tables = self.tables
+
+        if only_on_conflict:
+            if r in self.values:
+                if len(self.values[r]) < 2:  # only one source -- no conflicts
+                    return
+            elif r in tables:
+                if len(tables[r]) < 2:
+                    return
+            else:
+                return
+
+        if r in tables:  # replace the table by the value
+            tables_routes, values_routes = self._subtree(r)
+            for rr in tables_routes:
+                tables.pop(rr)
+            for rr in values_routes:
+                self.values.pop(rr)
+
+        for i in range(len(r)):
+            parent = r[:i]
+            if parent not in tables:
+                self.values.pop(parent, None)  # the value is replaced by the table
+                tables[parent] = {}
+            tables[parent][r[i]] = None
+
+        self.values[r] = TomlValue.from_value(value, -1)
+
+
+def union_flat_dicts(dicts: Iterable[TOML_DICT], partial: bool = False) -> FlatData:
+    """
+    perform to flat data conversion and flat data union for all input dicts,
+        partial union keeps pending values instead of failing on the tables without version
+
+    >>> t1 = dict(a=1, b=[2], c={'d': [3, 4]})
+    >>> t2 = dict(b=[3], c={'d': [6, 4], 'e': 8})
+    >>> union_flat_dicts([t1, t2]).to_data_dict() == union_dicts([t1, t2])
+    True
+    """
+    result = FlatData({}, {(): {}}, pending={} if partial else None)
+
+    for i, dct in enumerate(dicts):
+        result.add_dict(dct, i)
+
+    return result
+
+
+#endregion
+
+
+#region SOURCES
+
+def _match_file(path: str, pattern: str, glob: str) -> bool:
+    """checks whether the path is matched by the pattern: exact file, folder (files inside are matched by the glob) or fnmatch pattern"""
+    if path == pattern:
+        return True
+
+    folder = pattern.strip('/')
+    if path.startswith(folder + '/' if folder else '') and fnmatch.fnmatch(path.rsplit('/', 1)[-1], glob):
+        return True
+
+    return fnmatch.fnmatch(path, pattern)
+
+
+def _match_files(paths: Iterable[str], pattern: str, glob: str) -> List[str]:
+    """
+    selects paths by the pattern, see _match_file
+
+    >>> ps = ['pyproject.toml', 'a/pyproject.toml', 'a/b/c.toml', 'a/b/d.txt']
+    >>> _match_files(ps, 'a/pyproject.toml', '*.toml'), _match_files(ps, 'a', '*.toml'), _match_files(ps, '', '*.toml')
+    (['a/pyproject.toml'], ['a/pyproject.toml', 'a/b/c.toml'], ['pyproject.toml', 'a/pyproject.toml', 'a/b/c.toml'])
+    >>> _match_files(ps, '*/pyproject.toml', '*.toml')
+    ['a/pyproject.toml']
+    """
+    return [p for p in paths if _match_file(p, pattern, glob)]
+
+
+def is_git_input(file: Union[str, os.PathLike]) -> bool:
+    """checks whether the input is in form rev:path/glob and is not an existing path"""
+    return isinstance(file, str) and ':' in file and not os.path.exists(file)
+
+
+ARCHIVE_SUFFIXES = ('.zip', '.whl', '.egg', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+"""archives extensions to search in folders"""
+
+ARCHIVE_SEP = '!'
+"""archive path and inner path separator"""
+
+
+def is_archive_input(file: Union[str, os.PathLike]) -> bool:
+    """checks whether the input is in form archive!path/glob or just an archive file"""
+    file = str(file)
+    if os.path.exists(file):
+        return os.path.isfile(file) and file.lower().endswith(ARCHIVE_SUFFIXES)
+    return ARCHIVE_SEP in file and os.path.exists(file.split(ARCHIVE_SEP, 1)[0])
+
+
+def read_archive(
+    archive: Union[str, os.PathLike],
+    pattern: str = '',
+    glob: str = '*.toml'
+) -> List[Tuple[str, bytes]]:
+    """
+    reads matching files from zip (wheel) or tar (sdist) archive without extraction
+
+    Args:
+        archive: archive path
+        pattern: inner path pattern like in _match_file
+        glob: pattern of files to search in folders
+
+    Returns:
+        list of (archive!member label, content) pairs
+    """
+    result = []
+
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as z:
+            for info in z.infolist():
+                if not info.is_dir() and _match_file(info.filename, pattern, glob):
+                    result.append((info.filename, z.read(info)))
+    else:
+        with tarfile.open(archive, mode='r|*') as tar:  # stream mode: members are read in one pass
+            for member in tar:
+                name = member.name[2:] if member.name.startswith('./') else member.name
+                if member.isfile() and _match_file(name, pattern, glob):
+                    result.append((name, tar.extractfile(member).read()))
+
+    return [
+        (f"{archive}{ARCHIVE_SEP}{name}", content) for name, content in result
+    ]
+
+
+def read_archives(
+    specs: Union[str, os.PathLike, Iterable[Union[str, os.PathLike]]],
+    glob: str = '*.toml',
+    workers: Optional[int] = None
+) -> List[Tuple[str, bytes]]:
+    """
+    reads matching files from many archives concurrently
+
+    Args:
+        specs: archive!path/glob string or several ones, the archive may be a folder with archives
+        glob: pattern of files to search in folders
+        workers: count of threads to read archives, None means ThreadPoolExecutor default
+
+    Returns:
+        list of (archive!member label, content) pairs in specs order
+    """
+    if isinstance(specs, (str, os.PathLike)):
+        specs = [specs]
+    return [item for group in _read_archives_groups(specs, glob=glob, workers=workers) for item in group]
+
+
+def _read_archives_groups(
+    specs: Iterable[Union[str, os.PathLike]],
+    glob: str = '*.toml',
+    workers: Optional[int] = None
+) -> List[List[Tuple[str, bytes]]]:
+    """same as read_archives but returns the pairs of each spec separately, all archives share one executor"""
+    tasks: List[List[Tuple[Path, str]]] = []
+    """(archive, pattern) pairs of each spec"""
+    for spec in specs:
+        spec = str(spec)
+        path, pattern = spec.split(ARCHIVE_SEP, 1) if ARCHIVE_SEP in spec else (spec, '')
+
+        path = Path(path)
+        archives = sorted(
+            p for p in path.rglob('*') if p.is_file() and p.name.lower().endswith(ARCHIVE_SUFFIXES)
+        ) if path.is_dir() else [path]
+        tasks.append([(a, pattern) for a in archives])
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [
+            [executor.submit(read_archive, a, pattern=pattern, glob=glob) for a, pattern in group]
+            for group in tasks
+        ]
+        return [
+            [item for f in group for item in f.result()]
+            for group in futures
+        ]
+
+
+class GitBlobReader:
+    """
+    reads files from git revisions without checkout,
+        the contents are streamed through one long-lived `git cat-file --batch` process
+    """
+
+    def __init__(self, repo: Optional[Union[str, os.PathLike]] = None):
+        """
+        Args:
+            repo: git repository path, None means current directory
+        """
+        self.repo = repo
+        self._process: Optional[subprocess.Popen] = None
+
+    def _command(self, *args: str) -> List[str]:
+        return ['git'] + (['-C', str(self.repo)] if self.repo else []) + list(args)
+
+    def list_blobs(self, rev: str) -> Dict[str, str]:
+        """returns { path -> blob sha } for all files on the revision"""
+        process = subprocess.run(
+            self._command('ls-tree', '-r', '-z', '--full-tree', rev),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        if process.returncode:
+            raise ValueError(
+                f"cannot list files of git revision {rev}: {process.stderr.decode('utf-8', 'replace').strip()}"
+            )
+
+        blobs = {}
+        for entry in process.stdout.decode('utf-8').split('\0'):
+            if not entry:
+                continue
+            info, path = entry.split('\t', 1)
+            _, kind, sha = info.split()
+            if kind == 'blob':
+                blobs[path] = sha
+        return blobs
+
+    def read_blobs(self, shas: List[str]) -> List[bytes]:
+        """reads blobs contents by their shas in one batch"""
+        if not shas:
+            return []
+
+        if self._process is None:
+            self._process = subprocess.Popen(
+                self._command('cat-file', '--batch'),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+        process = self._process
+
+        def write_requests():
+            process.stdin.write(''.join(f"{sha}\n" for sha in shas).encode())
+            process.stdin.flush()
+
+        writer = threading.Thread(target=write_requests, daemon=True)  # avoids pipes deadlock on big batches
+        writer.start()
+
+        result = []
+        for sha in shas:
+            header = process.stdout.readline().split()
+            if len(header) != 3:
+                raise ValueError(f"cannot read git blob {sha}: {b' '.join(header).decode()}")
+            size = int(header[2])
+            result.append(process.stdout.read(size))
+            process.stdout.read(1)  # trailing newline
+
+        writer.join()
+        return result
+
+    def read(self, spec: str, glob: str = '*.toml') -> List[Tuple[str, bytes]]:
+        """
+        reads files by the spec
+
+        Args:
+            spec: rev:path/glob string like HEAD:pyproject.toml, v1.0:services or main:*/pyproject.toml
+            glob: pattern of files to search in folders
+
+        Returns:
+            list of (rev:path label, content) pairs
+        """
+        rev, pattern = spec.split(':', 1)
+        blobs = self.list_blobs(rev)
+        paths = _match_files(blobs, pattern, glob)
+        return [
+            (f"{rev}:{path}", content)
+            for path, content in zip(paths, self.read_blobs([blobs[p] for p in paths]))
+        ]
+
+    def close(self):
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#endregion
+
+
+#region INDEX
+
+INDEX_VERSION = 1
+"""version of the saved index format"""
+
+
+def _index_value(value: Any) -> str:
+    """converts the value to the index key, booleans are written as in TOML"""
+    return json.dumps(value) if isinstance(value, bool) else str(value)
+
+
+@dataclass
+class UnionIndex:
+    """
+    reverse index over the union to answer which files define routes and values
+
+    >>> t1 = {'deps': {'torch': {'version': '1.0', 'source': 'pytorch'}, 'numpy': '1.0'}}
+    >>> t2 = {'deps': {'torch': '2.0'}}
+    >>> i = UnionIndex.build(union_dicts([t1, t2]), files=['f1', 'f2'])
+    >>> i.query(route='deps.torch')
+    {'deps.torch.source': {'pytorch': ['f1']}, 'deps.torch.version': {'1.0': ['f1'], '2.0': ['f2']}}
+    >>> i.query(value='1.0')
+    {'deps.numpy': {'1.0': ['f1']}, 'deps.torch.version': {'1.0': ['f1']}}
+    >>> i.query(route='*.torch.version', value='2.0')
+    {'deps.torch.version': {'2.0': ['f2']}}
+    >>> UnionIndex.build(union_dicts([{'optional': False}]), files=['f1']).query(value='false')
+    {'optional': {'false': ['f1']}}
+    """
+
+    files: List[str]
+    """sources labels"""
+    routes: Dict[str, Dict[str, List[int]]]
+    """route -> value -> sources indexes, routes are sorted"""
+    values: Dict[str, List[str]]
+    """value -> routes with it"""
+
+    def __post_init__(self):
+        self._routes_list: List[str] = list(self.routes)
+        """sorted routes for prefix search"""
+
+    @staticmethod
+    def build(dct: Union[DATA_DICT, FlatData], files: List[str]) -> 'UnionIndex':
+        """
+        builds the index from data dict or flat data
+
+        Args:
+            dct: union before removals and overrides
+            files: sources labels in order of their indexes in the data dict
+
+        Notes:
+            values are converted to strings like TOML literals, negative sources (overrides) are not included
+        """
+        routes: Dict[str, Dict[str, List[int]]] = {}
+        values: Dict[str, List[str]] = defaultdict(list)
+
+        for route, value, _ in (dct.iter_values() if isinstance(dct, FlatData) else iter_data_dict(dct)):
+            r = '.'.join(route)
+            route_values = routes.setdefault(r, {})
+            for v, sources in value.map.items():
+                sources = [s for s in sources if s >= 0]
+                if not sources:
+                    continue
+                v = _index_value(v)
+                if v not in route_values:
+                    values[v].append(r)
+                _add_sources_to_dict(route_values, v, sources)
+
+        return UnionIndex(
+            files=list(files),
+            routes={r: routes[r] for r in sorted(routes)},
+            values={v: sorted(rs) for v, rs in values.items()}
+        )
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'version': INDEX_VERSION,
+            'files': self.files,
+            'routes': self.routes,
+            'values': self.values
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> 'UnionIndex':
+        assert data.get('version') == INDEX_VERSION, f"unsupported index version {data.get('version')}"
+        return UnionIndex(files=data['files'], routes=data['routes'], values=data['values'])
+
+    def save(self, file_name: Union[str, os.PathLike], only_if_changed: bool = False) -> bool:
+        return write_text(file_name, json.dumps(self.to_json()), only_if_changed=only_if_changed)
+
+    @staticmethod
+    def load(file_name: Union[str, os.PathLike]) -> 'UnionIndex':
+        return UnionIndex.from_json(json.loads(read_text(file_name)))
+
+    def _match_routes(self, route: str) -> List[str]:
+        """routes matching exact route, its subroutes or the pattern"""
+        if any(c in route for c in '*?['):
+            return [r for r in self.routes if fnmatch.fnmatchcase(r, route)]
+
+        routes = self._routes_list  # sorted, so subroutes are in one range
+        prefix = route + '.'
+        start = bisect.bisect_left(routes, route)
+        result = []
+        for r in itertools.islice(routes, start, None):
+            if r == route or r.startswith(prefix):
+                result.append(r)
+            elif not r.startswith(route):
+                break
+        return result
+
+    def query(self, route: Optional[str] = None, value: Optional[str] = None) -> Dict[str, Dict[str, List[str]]]:
+        """
+        finds sources of routes and values
+
+        Args:
+            route: route like tool.poetry.dependencies.torch (with subroutes) or fnmatch pattern
+            value: value to find
+
+        Returns:
+            { route -> value -> sources labels }
+        """
+        assert route is not None or value is not None, 'route or value is required'
+
+        if value is not None:
+            value = _index_value(value)
+
+        if route is None:
+            routes = self.values.get(value, [])
+        else:
+            routes = self._match_routes(route)
+
+        result = {}
+        for r in routes:
+            route_values = self.routes[r]
+            if value is not None:
+                route_values = {value: route_values[value]} if value in route_values else {}
+            if route_values:
+                result[r] = {
+                    v: [self.files[i] for i in sources] for v, sources in route_values.items()
+                }
+        return result
+
+
+#endregion
+
+
+#region PARTIAL STATE
+
+PARTIAL_FORMAT = 'toml-union-partial'
+"""format name of the saved partial state"""
+
+PARTIAL_VERSION = 1
+"""version of the saved partial state format"""
+
+
+@dataclass
+class PartialState:
+    """
+    union state before removals and overrides with its sources labels,
+        the states of different files shards can be saved and combined to same result as for all files
+
+    >>> t1, t2, t3 = dict(a=1, b=[1]), dict(a=2, b=[2], c={'d': 3}), dict(a=1, c={'d': 4})
+    >>> s1 = PartialState(union_flat_dicts([t1]), files=['f1'])
+    >>> s2 = PartialState(union_flat_dicts([t2, t3]), files=['f2', 'f3'])
+    >>> s = PartialState.combine([s1, PartialState.from_json(json.loads(json.dumps(s2.to_json())))])
+    >>> s.files
+    ['f1', 'f2', 'f3']
+    >>> s.data == union_flat_dicts([t1, t2, t3])
+    True
+    """
+
+    data: FlatData
+    """union result before removals and overrides"""
+    files: List[str]
+    """sources labels"""
+    identity_keys: Optional[IDENTITY_KEYS] = None
+    """lock mode identity keys used to read the sources"""
+
+    def to_json(self) -> Dict[str, Any]:
+        def encode(value: TomlValue) -> List[list]:
+            return [[v, sources] for v, sources in value.map.items()]
+
+        return {
+            'format': PARTIAL_FORMAT,
+            'version': PARTIAL_VERSION,
+            'files': self.files,
+            'identity_keys': None if self.identity_keys is None else {
+                k: list(v) for k, v in self.identity_keys.items()
+            },
+            'tables': [
+                [list(route), list(keys)] for route, keys in self.data.tables.items()
+            ],
+            'values': [
+                [list(route), True, [encode(v) for v in value]] if isinstance(value, list)
+                else [list(route), False, encode(value)]
+                for route, value in self.data.values.items()
+            ],
+            'pending': [
+                [list(route), encode(value)] for route, value in (self.data.pending or {}).items()
+            ]
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> 'PartialState':
+        assert data.get('format') == PARTIAL_FORMAT, 'it is not toml-union partial state'
+        assert data.get('version') == PARTIAL_VERSION, f"unsupported partial state version {data.get('version')}"
+
+        def decode(pairs: List[list]) -> TomlValue:
+            return TomlValue({v: sources for v, sources in pairs})
+
+        identity_keys = data['identity_keys']
+
+        return PartialState(
+            data=FlatData(
+                values={
+                    tuple(route): [decode(v) for v in value] if is_list else decode(value)
+                    for route, is_list, value in data['values']
+                },
+                tables={
+                    tuple(route): dict.fromkeys(keys) for route, keys in data['tables']
+                },
+                pending={
+                    tuple(route): decode(value) for route, value in data['pending']
+                }
+            ),
+            files=data['files'],
+            identity_keys=None if identity_keys is None else {k: tuple(v) for k, v in identity_keys.items()}
+        )
+
+    def save(self, file_name: Union[str, os.PathLike], only_if_changed: bool = False) -> bool:
+        return write_text(
+            file_name, json.dumps(self.to_json(), separators=(',', ':')), only_if_changed=only_if_changed
+        )
+
+    @staticmethod
+    def load(file_name: Union[str, os.PathLike]) -> 'PartialState':
+        return PartialState.from_json(json.loads(read_text(file_name)))
+
+    @staticmethod
+    def combine(states: Iterable['PartialState']) -> 'PartialState':
+        """
+        combines the states to one with sources indexes remapping and resolves pending values,
+            the result is same as for the union of all their files in same order if that union succeeds
+
+        Notes:
+            input states are consumed
+        """
+        result: Optional[PartialState] = None
+
+        for state in states:
+            if result is None:
+                result = PartialState(FlatData({}, {(): {}}, pending={}), files=[], identity_keys=state.identity_keys)
+            assert state.identity_keys == result.identity_keys, (
+                f"cannot combine states with different identity keys: {state.identity_keys} and {result.identity_keys}"
+            )
+
+            offset = len(result.files)
+            if offset:
+                for value in itertools.chain(state.data.values.values(), (state.data.pending or {}).values()):
+                    for v in (value if isinstance(value, list) else [value]):
+                        v.map = {k: [s + offset for s in sources] for k, sources in v.map.items()}
+
+            result.data.update(state.data)
+            result.files.extend(state.files)
+
+        assert result is not None, 'no states to combine'
+        result.data.resolve_pending()
+        return result
+
+
+#endregion
+
+
 #region MAIN
 
+@dataclass
+class UnionResult:
+    """in-memory union result"""
+
+    output: TOML_DICT
+    """result shortened dict with the real toml structure like it is written to the file"""
+    report: Optional[TOML_DICT]
+    """
+    conflicts report with sources labels, None if there are no conflicts;
+        arrays of tables are kept as tables with the identity in keys like source___pytorch
+        or package___requests___2.31.0 in lock mode, because the report values are the maps
+    """
+    data: Optional[DATA_DICT]
+    """result wide data dict, None if it is not requested"""
+
+
+def _union_flat_documents(
+    docs: Iterable[Union[TOML_DICT, str, bytes]],
+    identity_keys: Optional[IDENTITY_KEYS] = None,
+    partial: bool = False
+) -> Tuple[FlatData, int]:
+    """performs union of the documents and returns flat result with documents count, partial is for union_flat_dicts"""
+
+    docs_count: int = 0
+
+    def normalized() -> Iterable[TOML_DICT]:
+        """lazy docs conversion, so only one of them is kept in memory"""
+        nonlocal docs_count
+        for d in docs:
+            docs_count += 1
+            yield (
+                loads_toml(d, identity_keys=identity_keys) if isinstance(d, (str, bytes))
+                else disable_lists_dict(d, identity_keys=identity_keys)
+            )
+
+    flat: FlatData = union_flat_dicts(normalized(), partial=partial)
+    assert docs_count, 'no documents to union'
+
+    return flat, docs_count
+
+
+def _finish_union(
+    flat: FlatData,
+    labels: List[str],
+    remove_fields: Optional[Iterable[str]] = None,
+    overrides: Dict[str, Any] = None,
+    overrides_on_conflicts: Dict[str, Any] = None,
+    identity_keys: Optional[IDENTITY_KEYS] = None,
+    with_report: bool = True,
+    with_data: bool = True
+) -> UnionResult:
+    """
+    applies removals and overrides to the union and converts it to the result,
+        the report and the data are built only if they are requested
+    """
+
+    remove_fields = remove_fields or []
+    if remove_fields:
+        for r in remove_fields:
+            flat.remove(r)
+
+    if overrides:
+        # override result params
+        for k, v in overrides.items():
+            flat.override(k, v)
+
+    if overrides_on_conflicts:
+        for k, v in overrides_on_conflicts.items():
+            flat.override(k, v, only_on_conflict=True)
+
+    if not with_report:
+        return UnionResult(
+            output=enable_lists_dicts(flat.to_dict(), identity_keys=identity_keys),
+            report=None,
+            data=flat.to_data_dict() if with_data else None
+        )
+
+    conflict: bool = False
+    """flag about some conflicts existence"""
+
+    def serializer(obj: TomlValue):
+        """wrapper under class json serializer"""
+        nonlocal conflict
+        res = obj.to_json()
+        if isinstance(res, dict):
+            res = {
+                _k: [labels[vv] for vv in _v]
+                for _k, _v in res.items()
+            }
+            conflict = True  # set flag about conflict
+        return res
+
+    report = flat.to_dict(converter=serializer)
+
+    return UnionResult(
+        output=enable_lists_dicts(flat.to_dict(), identity_keys=identity_keys),
+        report=report if conflict else None,
+        data=flat.to_data_dict() if with_data else None
+    )
+
+
+def _import_analytics():
+    """imports analytics classes which require the installed package with numpy"""
+    try:
+        from .analytics import ConflictMatrix, write_analytics
+    except ImportError as e:
+        raise ImportError(
+            f"conflicts analytics requires toml-union package installed with numpy "
+            f"(pip install toml-union[analytics]): {e}"
+        ) from e
+    return ConflictMatrix, write_analytics
+
+
+def _write_union_artifacts(
+    flat: FlatData,
+    labels: List[str],
+    only_if_changed: bool = False,
+    analytics: Optional[Union[str, os.PathLike]] = None,
+    index: Optional[Union[str, os.PathLike]] = None
+):
+    """
+    writes analytics and index of the union before removals and overrides,
+        so they keep the sources of the values resolved by overrides
+    """
+    if analytics:
+        ConflictMatrix, write_analytics = _import_analytics()
+        write_analytics(
+            analytics,
+            ConflictMatrix.from_data_dict(flat, files=labels),
+            only_if_changed=only_if_changed
+        )
+
+    if index:
+        UnionIndex.build(flat, files=labels).save(index, only_if_changed=only_if_changed)
+
+
+def _write_union_result(
+    result: UnionResult,
+    labels: List[str],
+    outfile: Optional[Union[str, os.PathLike]] = None,
+    report: Optional[Union[str, os.PathLike]] = None,
+    unicode_escape: bool = False,
+    only_if_changed: bool = False,
+    identity_keys: Optional[IDENTITY_KEYS] = None,
+    print_output: bool = True
+):
+    """writes union result files, see toml_union_process for arguments"""
+
+    if outfile is None:
+        if print_output:
+            print(dumps_toml(result.output, unicode_escape=unicode_escape, identity_keys=identity_keys))
+    else:
+        write_toml(  # repeated enable_lists_dicts does not change the output
+            outfile, result.output,
+            unicode_escape=unicode_escape, only_if_changed=only_if_changed, identity_keys=identity_keys
+        )
+
+    if report and result.report is not None:
+        write_json(report, result.report, only_if_changed=only_if_changed)
+
+
+def union_documents(
+    docs: Iterable[Union[TOML_DICT, str, bytes]],
+    labels: Optional[List[str]] = None,
+    remove_fields: Optional[Iterable[str]] = None,
+    overrides: Dict[str, Any] = None,
+    overrides_on_conflicts: Dict[str, Any] = None,
+    identity_keys: Optional[IDENTITY_KEYS] = None
+) -> UnionResult:
+    """
+    Union several toml documents in memory without any filesystem usage
+
+    Args:
+        docs: parsed toml dicts or toml texts
+        labels: sources names for the report in same order as docs, default is their indexes
+        remove_fields: same as in toml_union_process
+        overrides: same as in toml_union_process
+        overrides_on_conflicts: same as in toml_union_process
+        identity_keys: same as in toml_union_process
+
+    >>> r = union_documents([b'a = 1\\nb = 2', dict(a=1, b=3)], labels=['x', 'y'], overrides={'c.d': 4})
+    >>> r.output
+    {'a': 1, 'b': [2, 3], 'c': {'d': 4}}
+    >>> r.report
+    {'a': 1, 'b': {2: ['x'], 3: ['y']}, 'c': {'d': 4}}
+
+    the output has real arrays of tables while the report keeps them in keys:
+    >>> r = union_documents([b'[[source]]\\nname = "pytorch"\\nurl = "u1"', b'[[source]]\\nname = "pytorch"\\nurl = "u2"'])
+    >>> r.output
+    {'source': [{'url': ['u1', 'u2'], 'name': 'pytorch'}]}
+    >>> r.report
+    {'source___pytorch': {'url': {'u1': ['0'], 'u2': ['1']}}}
+    """
+
+    flat, docs_count = _union_flat_documents(docs, identity_keys=identity_keys)
+
+    if labels is None:
+        labels = [str(i) for i in range(docs_count)]
+    assert len(labels) == docs_count, f"got {len(labels)} labels for {docs_count} documents"
+
+    return _finish_union(
+        flat, labels,
+        remove_fields=remove_fields, overrides=overrides, overrides_on_conflicts=overrides_on_conflicts,
+        identity_keys=identity_keys
+    )
+
+
 def toml_union_process(
     files: Iterable[Union[str, os.PathLike]],
     outfile: Optional[Union[str, os.PathLike]] = None,
@@ -523,14 +1826,24 @@ def toml_union_process(
     remove_fields: Optional[Iterable[str]] = None,
     overrides: Dict[str, Any] = None,
     overrides_on_conflicts: Dict[str, Any] = None,
-    unicode_escape: bool = False
+    unicode_escape: bool = False,
+    only_if_changed: bool = False,
+    analytics: Optional[Union[str, os.PathLike]] = None,
+    identity_keys: Optional[IDENTITY_KEYS] = None,
+    glob: str = '*.toml',
+    git_repo: Optional[Union[str, os.PathLike]] = None,
+    workers: Optional[int] = None,
+    index: Optional[Union[str, os.PathLike]] = None,
+    partial: Optional[Union[str, os.PathLike]] = None
 ) -> None:
     """
     Union several toml files to one
 
     Args:
-        files: input files or folders with them
-        outfile: result file
+        files: input files or folders with them or git revisions files in form rev:path/glob
+            like HEAD:pyproject.toml, v1.0:services or main:*/pyproject.toml
+            or archives (or folders with them) files in form archive!path/glob like dist/pkg.tar.gz!*/pyproject.toml
+        outfile: result file, None means to print it to console (if partial is not set)
         report: file to report in case of conflicts, None means disable
         remove_fields: some fields like d1.d2.d3, toml.build and so on -- to remove from target file,
             works before overrides
@@ -538,6 +1851,18 @@ def toml_union_process(
             "dct1.dct2.key": "value"
         overrides_on_conflicts: same as overrides but will be performed only on conflict fields
         unicode_escape: whether to escape unicode sequences
+        only_if_changed: whether to skip writing outfile and report if they already have same content,
+            it keeps their mtimes for downstream caches
+        analytics: *.json or *.csv file for conflicts analytics by files (requires numpy), None means disable
+        identity_keys: lock mode -- fields which identify items of arrays of tables by their keys,
+            like LOCK_IDENTITY_KEYS for poetry.lock files; None means usual mode
+        glob: pattern of files to search in input folders
+        git_repo: git repository for rev:path/glob inputs, None means current directory
+        workers: count of threads to read archives, None means default
+        index: file to save the reverse index of the union (before removals and overrides) for queries, None means disable
+        partial: file to save the union state (before removals and overrides) for combine_partials,
+            None means disable; the values which meet the tables without version are kept in the state
+            to be resolved by combine_partials, other outputs are written only if they are set
 
     """
 
@@ -545,71 +1870,117 @@ def toml_union_process(
     if isinstance(files, str):
         files = [files]
 
-    toml_files = []
-    for f in files:
-        p = Path(f)
-        if p.is_file():
-            toml_files.append(p)
-        else:
-            toml_files.extend(
-                p.rglob('*.toml')
-            )
-    
-    assert toml_files, f"no such *.toml files in {files}"
+    sources: List[Tuple[str, Union[Path, bytes]]] = []
+    """(label, file path or content) pairs"""
 
-    datas: DATA_DICT = union_dicts(
-        read_toml(file) for file in toml_files
+    files = list(files)
+    archives = iter(  # all archives inputs are read concurrently at once
+        _read_archives_groups(
+            [f for f in files if is_archive_input(f)], glob=glob, workers=workers
+        )
     )
-    """result wide data dict"""
 
-    remove_fields = remove_fields or []
-    if remove_fields:
-        for r in remove_fields:
-            remove_field(datas, r)
+    with GitBlobReader(git_repo) as git:
+        for f in files:
+            if is_archive_input(f):
+                sources.extend(next(archives))
+                continue
 
-    if overrides:
-        # override result params
-        for k, v in overrides.items():
-            override_param(datas, k, v)
+            if is_git_input(f):
+                sources.extend(git.read(f, glob=glob))
+                continue
 
-    if overrides_on_conflicts:
-        for k, v in overrides_on_conflicts.items():
-            override_param(datas, k, v, only_on_conflict=True)
+            p = Path(f)
+            if p.is_file():
+                sources.append((str(p), p))
+            else:
+                sources.extend(
+                    (str(file), file) for file in p.rglob(glob)
+                )
 
-    outdict = to_dict(datas)
-    """result shortened dict"""
-    
-    if outfile is None:
-        _, f = tempfile.mkstemp(prefix='toml-union', text=True)
-        write_toml(f, outdict, unicode_escape=unicode_escape)
-        print(read_text(f))
-        os.unlink(f)
-    else: 
-        write_toml(outfile, outdict, unicode_escape=unicode_escape)
-
-    if report:
-        index_file_map: List[str] = [
-            str(f) for i, f in enumerate(toml_files)
-        ]
+    assert sources, f"no such {glob} files in {files}"
 
-        conflict: bool = False
-        """flag about some conflicts existence"""
-
-        def serializer(obj: TomlValue):
-            """wrapper under class json serializer"""
-            nonlocal conflict
-            res = obj.to_json()
-            if isinstance(res, dict):
-                res = {
-                    _k: [index_file_map[vv] for vv in _v]
-                    for _k, _v in res.items()
-                }
-                conflict = True  # set flag about conflict
-            return res
+    index_file_map: List[str] = [
+        label for label, _ in sources
+    ]
+
+    flat, _ = _union_flat_documents(
+        (read_text(source) if isinstance(source, Path) else source for _, source in sources),
+        identity_keys=identity_keys,
+        partial=bool(partial)
+    )
+
+    if partial:  # save before removals and overrides which change the data
+        PartialState(flat, files=index_file_map, identity_keys=identity_keys).save(
+            partial, only_if_changed=only_if_changed
+        )
+        if not (outfile or report or analytics or index):
+            return
+        flat.resolve_pending()  # the shard own result fails like the union of its files only
+    _write_union_artifacts(
+        flat, index_file_map, only_if_changed=only_if_changed, analytics=analytics, index=index
+    )
+
+    result = _finish_union(
+        flat, index_file_map,
+        remove_fields=remove_fields, overrides=overrides, overrides_on_conflicts=overrides_on_conflicts,
+        identity_keys=identity_keys, with_report=bool(report), with_data=False
+    )
+
+    _write_union_result(
+        result, index_file_map,
+        outfile=outfile, report=report,
+        unicode_escape=unicode_escape, only_if_changed=only_if_changed,
+        identity_keys=identity_keys, print_output=not partial
+    )
+
+
+def combine_partials(
+    partials: Iterable[Union[str, os.PathLike]],
+    outfile: Optional[Union[str, os.PathLike]] = None,
+    report: Optional[Union[str, os.PathLike]] = None,
+    remove_fields: Optional[Iterable[str]] = None,
+    overrides: Dict[str, Any] = None,
+    overrides_on_conflicts: Dict[str, Any] = None,
+    unicode_escape: bool = False,
+    only_if_changed: bool = False,
+    analytics: Optional[Union[str, os.PathLike]] = None,
+    index: Optional[Union[str, os.PathLike]] = None
+) -> None:
+    """
+    Combines partial states saved by toml_union_process to final result,
+        it is the same as toml_union_process over all their files in same order;
+        the values which met the tables without version in some states fail only if no state has the version,
+        so it can succeed where toml_union_process over all files fails on the order of such files
+
+    Args:
+        partials: partial states files
+        other arguments: same as in toml_union_process
+
+    """
+
+    if isinstance(partials, (str, os.PathLike)):
+        partials = [partials]
+
+    state = PartialState.combine(
+        PartialState.load(p) for p in partials
+    )
+    _write_union_artifacts(
+        state.data, state.files, only_if_changed=only_if_changed, analytics=analytics, index=index
+    )
+
+    result = _finish_union(
+        state.data, state.files,
+        remove_fields=remove_fields, overrides=overrides, overrides_on_conflicts=overrides_on_conflicts,
+        identity_keys=state.identity_keys, with_report=bool(report), with_data=False
+    )
 
-        outdict = to_dict(datas, converter=serializer)
-        if conflict:
-            write_json(report, outdict)
+    _write_union_result(
+        result, state.files,
+        outfile=outfile, report=report,
+        unicode_escape=unicode_escape, only_if_changed=only_if_changed,
+        identity_keys=state.identity_keys
+    )
 
 
 #endregion
@@ -635,34 +2006,41 @@ class kvdictAppendAction(argparse.Action):
         setattr(args, self.dest, d)
 
 
-parser = argparse.ArgumentParser(
-    prog=f"{os.path.basename(__file__)}",
-    description='Combines several toml files to one with conflicts showing',
-    formatter_class=argparse.ArgumentDefaultsHelpFormatter
-)
-
+output_parser = argparse.ArgumentParser(add_help=False)
+"""common arguments of union and combine commands"""
 
-parser.add_argument(
-    'INPUT', action='store', type=str, nargs='+',
-    help='input toml files paths',
-)
-parser.add_argument(
+output_parser.add_argument(
     '--output', '-o', action='store', type=str,
     help='output toml file path, empty value means to print to console',
     dest='outfile'
 )
 
-parser.add_argument(
+output_parser.add_argument(
     '--unicode-escape', '-u', action='store_true',
     help='whether to try to escape unicode sequences in the outfile, useful when outfile has many slashes and codes'
 )
 
-parser.add_argument(
+output_parser.add_argument(
+    '--only-if-changed', '-w', action='store_true',
+    help='whether to skip writing output and report files if they already have same content'
+)
+
+output_parser.add_argument(
     '--report', '-r', action='store', type=str, default=None,
     help='path to report json on failure'
 )
 
-parser.add_argument(
+output_parser.add_argument(
+    '--analytics', '-a', action='store', type=str, default=None,
+    help='path to *.json or *.csv file for conflicts analytics by files (requires numpy)'
+)
+
+output_parser.add_argument(
+    '--index', '-x', action='store', type=str, default=None,
+    help='path to save the reverse index of the union for query command'
+)
+
+output_parser.add_argument(
     "--remove-field", "-e",
     nargs='*',
     action='extend',
@@ -671,7 +2049,7 @@ parser.add_argument(
     dest='remove_fields'
 )
 
-parser.add_argument(
+output_parser.add_argument(
     "--key-value", "-k",
     nargs=1,
     action=kvdictAppendAction,
@@ -682,7 +2060,7 @@ parser.add_argument(
     dest='overrides_kwargs'
 )
 
-parser.add_argument(
+output_parser.add_argument(
     "--ckey-value", "-c",
     nargs=1,
     action=kvdictAppendAction,
@@ -694,6 +2072,118 @@ parser.add_argument(
 )
 
 
+parser = argparse.ArgumentParser(
+    prog=f"{os.path.basename(__file__)}",
+    description='Combines several toml files to one with conflicts showing',
+    epilog=(
+        f"subcommands: 'query INDEX' finds sources in the index saved by --index, "
+        f"'combine PARTIAL [PARTIAL ...]' combines the states saved by --partial, "
+        f"see '{os.path.basename(__file__)} query -h' and '{os.path.basename(__file__)} combine -h'; "
+        f"inputs named query or combine must be passed like ./query"
+    ),
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    parents=[output_parser]
+)
+
+parser.add_argument(
+    'INPUT', action='store', type=str, nargs='+',
+    help='input toml files or folders paths, git revisions files in form rev:path/glob '
+         'or archives files in form archive!path/glob',
+)
+
+parser.add_argument(
+    '--partial', '-p', action='store', type=str, default=None,
+    help='path to save the union state for combine command, the output is not printed to console with it'
+)
+
+parser.add_argument(
+    '--glob', '-g', action='store', type=str, default='*.toml',
+    help='pattern of files to search in input folders'
+)
+
+parser.add_argument(
+    '--git-repo', action='store', type=str, default=None,
+    help='git repository for INPUT in form rev:path/glob, empty value means current directory'
+)
+
+parser.add_argument(
+    '--workers', '-j', action='store', type=int, default=None,
+    help='count of threads to read archives, empty value means default'
+)
+
+parser.add_argument(
+    '--lock', '-l', action='store_true',
+    help='lock mode: merge arrays of tables of lock files like poetry.lock by their items identity keys'
+)
+
+parser.add_argument(
+    "--identity", "-i",
+    nargs=1,
+    action=kvdictAppendAction,
+    metavar="KEY=FIELDS",
+    default={},
+    type=str,
+    help="Lock mode with comma-separated identity fields for the array of tables key, like package=name,version. "
+         "May appear multiple times",
+    dest='identity_keys'
+)
+
+
+combine_parser = argparse.ArgumentParser(
+    prog=f"{os.path.basename(__file__)} combine",
+    description='Combines partial union states saved by --partial option to final result',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    parents=[output_parser]
+)
+
+combine_parser.add_argument(
+    'PARTIAL', action='store', type=str, nargs='+',
+    help='partial states files',
+)
+
+
+query_parser = argparse.ArgumentParser(
+    prog=f"{os.path.basename(__file__)} query",
+    description='Finds sources of routes and values in the saved union index',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+
+query_parser.add_argument(
+    'INDEX', action='store', type=str,
+    help='index file saved by --index option',
+)
+query_parser.add_argument(
+    '--route', action='store', type=str, default=None,
+    help='route like tool.poetry.dependencies.torch (with subroutes) or fnmatch pattern'
+)
+query_parser.add_argument(
+    '--value', '-v', action='store', type=str, default=None,
+    help='value to find'
+)
+
+
+def query_main(args: List[str]):
+    parsed = query_parser.parse_args(args)
+    if parsed.route is None and parsed.value is None:
+        query_parser.error('--route or --value is required')
+
+    print(
+        json.dumps(
+            UnionIndex.load(parsed.INDEX).query(route=parsed.route, value=parsed.value),
+            indent=2
+        )
+    )
+
+
+def _check_analytics(p: argparse.ArgumentParser, parsed: argparse.Namespace):
+    """fails with usage message before the union if analytics is requested but cannot be imported"""
+    if parsed.analytics:
+        try:
+            _import_analytics()
+        except ImportError as e:
+            p.error(str(e))
+
+
 def main():
 
     sys.path.append(
@@ -702,7 +2192,37 @@ def main():
 
     args = sys.argv[1:]
 
+    if args and args[0] == 'query':
+        query_main(args[1:])
+        return
+
+    if args and args[0] == 'combine':
+        parsed = combine_parser.parse_args(args[1:])
+        _check_analytics(combine_parser, parsed)
+        combine_partials(
+            parsed.PARTIAL,
+            outfile=parsed.outfile,
+            report=parsed.report,
+            remove_fields=parsed.remove_fields,
+            overrides=parsed.overrides_kwargs,
+            overrides_on_conflicts=parsed.overrides_kwargs_conflict,
+            unicode_escape=parsed.unicode_escape,
+            only_if_changed=parsed.only_if_changed,
+            analytics=parsed.analytics,
+            index=parsed.index
+        )
+        print()
+        return
+
     parsed = parser.parse_args(args)
+    _check_analytics(parser, parsed)
+
+    identity_keys = None
+    if parsed.lock or parsed.identity_keys:
+        identity_keys = dict(LOCK_IDENTITY_KEYS) if parsed.lock else {}
+        identity_keys.update(
+            {k: tuple(v.split(',')) for k, v in parsed.identity_keys.items()}
+        )
 
     toml_union_process(
         parsed.INPUT,
@@ -711,7 +2231,15 @@ def main():
         remove_fields=parsed.remove_fields,
         overrides=parsed.overrides_kwargs,
         overrides_on_conflicts=parsed.overrides_kwargs_conflict,
-        unicode_escape=parsed.unicode_escape
+        unicode_escape=parsed.unicode_escape,
+        only_if_changed=parsed.only_if_changed,
+        analytics=parsed.analytics,
+        identity_keys=identity_keys,
+        glob=parsed.glob,
+        git_repo=parsed.git_repo,
+        workers=parsed.workers,
+        index=parsed.index,
+        partial=parsed.partial
     )
 
     print()